@@ -1,10 +1,10 @@
 import abc
 import asyncio
+import collections
 import datetime
-import json
 import typing as tp
-from dataclasses import dataclass
 
+import msgspec
 import websockets
 
 symbols_config = [
@@ -15,6 +15,12 @@ symbols_config = [
 ]
 # Это легко можно вынести в отдельный файл
 BASE_URL = 'wss://stream.binance.com:9443/stream'
+PRICE_LIFETIME = datetime.timedelta(hours=1)
+WS_MAX_QUEUE = 1024
+# Binance позволяет не больше 1024 потоков на одно соединение
+MAX_STREAMS_PER_CONNECTION = 1024
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 60
 
 DROP_RELATIVE = lambda old, new: (old - new) / new
 
@@ -22,17 +28,36 @@ DROP_RELATIVE = lambda old, new: (old - new) / new
 # Можно использовать любые другие метрики
 # Например, вдруг нам захочется реагировать не на пададение, а на увеличение
 
+class TradeData(msgspec.Struct):
+    # Binance присылает цену строкой, нестрогий декодер сам переводит её в float
+    p: float
+
+
+class Frame(msgspec.Struct):
+    """
+    Схема сообщения из combined stream. Разбираем только нужные поля,
+    остальное msgspec пропускает, не создавая лишних объектов
+
+    """
+    stream: str
+    data: TradeData
+
+
+_decoder = msgspec.json.Decoder(Frame, strict=False)
+
+
 class AbstractAlertService(abc.ABC):
     """
     Сервис, отвечающий за уведомления о событиях
     Можно легко добавить другие реализации (например сервис уведомлений в телеграм,
     писать в файл или сразу совершать какое-то полезное действие)
-
+    alert вызывается синхронно: реализациям с долгим вводом-выводом стоит
+    запускать его в фоне (например через loop.create_task), чтобы не задерживать приём цен
 
     """
 
     @abc.abstractmethod
-    async def alert(self, msg):
+    def alert(self, msg):
         raise NotImplementedError()
 
 
@@ -42,7 +67,7 @@ class ConsoleAlertService(AbstractAlertService):
 
     """
 
-    async def alert(self, msg):
+    def alert(self, msg):
         print(f'{datetime.datetime.now()}: {msg}')
 
 
@@ -56,56 +81,84 @@ class AbstractSymbolStorage(abc.ABC):
     """
 
     @abc.abstractmethod
-    async def store(self, price: float):
+    async def store(self, price: float, ts: float):
+        """
+        :param ts: монотонное время получения цены в секундах (loop.time())
+        """
         raise NotImplementedError()
 
     @abc.abstractmethod
     def get_price(self):
+        """
+        :return максимальная цена за окно или None, если цен ещё не было
+        """
         raise NotImplementedError()
 
 
-@dataclass(order=True)
-class PriceAtTime:
-    price: float
-    datetime: datetime
-
-
 class LocalSymbolStorage(AbstractSymbolStorage):
     """
     Реализация сервиса для сохранения цены
     """
     lifetime: datetime.timedelta
 
-    def __init__(self, lifetime: datetime.timedelta):
+    def __init__(self, lifetime: datetime.timedelta, dedup_interval: datetime.timedelta = datetime.timedelta(0)):
+        """
+        :param dedup_interval: цена ниже последней сохранённой, пришедшая раньше этого интервала
+            после неё, не сохраняется. Это экономит вставки, когда цена немного проседает,
+            но пропущенная цена могла бы стать максимумом, когда более высокая уйдёт из окна.
+            Получается, что окно для неё заканчивается раньше на величину до dedup_interval:
+            максимум может оказаться заниженным, и часть падений останется без уведомления.
+            По умолчанию выключено. Должен быть меньше lifetime
+        """
+        # Иначе хвост может оказаться просроченным, и очередь опустеет при удалении из головы
+        if dedup_interval >= lifetime:
+            raise ValueError(f'dedup_interval ({dedup_interval}) must be less than lifetime ({lifetime})')
         self.lifetime = lifetime
-        self._price_history = {-1.0: PriceAtTime(-1, datetime.datetime.now())}
-        self._max_key = -1.0
-
-    async def store(self, price: PriceAtTime) -> None:
-        # Этот метод должен работать за O(log(n)), но я не нашел простого способа
-        # добиться этого в питоне. Мне кажется, сюда идеально вписалась бы TreeMap
-        # Где в корне всегда был бы максимальный элемент, достать его можно было бы
-        # за O(1), добавить новый или обновить старый можно было бы за O(log(n))
-        # Но я не смог найти подходящую реализацию, а писать свою мне кажется
-        # не совсем то, что предполагалось в тестовом задании
-        # Поэтому вставка работает за O(n) (в среднем)
-        while True:
-            top = self._price_history.get(self._max_key)
-            if price.datetime - top.datetime > self.lifetime:
-                self._price_history.pop(self._max_key)
-                self._max_key = max(self._price_history.keys())
-            else:
-                break
-        self._price_history[price.price] = price
-        self._max_key = max(price.price, self._max_key)
-
-    def get_price(self) -> float:
+        self._lifetime_seconds = lifetime.total_seconds()
+        self._dedup_seconds = dedup_interval.total_seconds()
+        # Монотонная очередь: цены в ней строго убывают от головы к хвосту,
+        # поэтому максимум за окно всегда лежит в голове
+        # Цены и время их получения (loop.time()) храним в двух параллельных очередях,
+        # чтобы не создавать объект на каждое сообщение
+        self._prices: tp.Deque[float] = collections.deque()
+        self._timestamps: tp.Deque[float] = collections.deque()
+
+    async def store(self, price: float, ts: float) -> None:
+        self.store_sync(price, ts)
+
+    def store_sync(self, price: float, ts: float) -> None:
+        # Хранилище в памяти ничего не ждёт, поэтому SymbolMonitor вызывает
+        # этот метод напрямую, без создания корутины на каждое сообщение
+        # Классическая задача о максимуме в скользящем окне: каждая цена
+        # попадает в очередь и покидает её не более одного раза,
+        # поэтому вставка работает за амортизированное O(1)
+        prices, timestamps = self._prices, self._timestamps
+        if prices and price < prices[-1] and ts - timestamps[-1] < self._dedup_seconds:
+            # Цена ниже хвоста и пришла почти сразу после него - пропускаем вставку
+            # Хвост свежий, поэтому очередь после удаления просроченных не опустеет
+            pass
+        else:
+            # Цены, не превосходящие новую, уже никогда не станут максимумом
+            while prices and prices[-1] <= price:
+                prices.pop()
+                timestamps.pop()
+            prices.append(price)
+            timestamps.append(ts)
+        # Выкидываем из головы просроченные значения
+        # Новая цена не может быть просроченной, поэтому очередь не опустеет
+        lifetime = self._lifetime_seconds
+        while ts - timestamps[0] > lifetime:
+            prices.popleft()
+            timestamps.popleft()
+
+    def get_price(self) -> tp.Optional[float]:
+        # None, пока не сохранено ни одной цены
         # По-хорошему, проверять то, что значение не просрочено, нужно здесь
         # Но это замедлит получение значения, что для нас критично
         # Так как обновления происходят достаточно часто (порядка раз в несколько секунд)
         # Получаемая в худшем случае ошибка будет такого же порядка, что,
         # при значении lifetime в 1 час, мне кажется, пренебрежимо мало
-        return self._max_key
+        return self._prices[0] if self._prices else None
 
 
 class SymbolMonitor:
@@ -121,25 +174,41 @@ class SymbolMonitor:
     def __init__(self, symbol: str, threshold: float, calc: tp.Callable, *, alert_service: AbstractAlertService,
                  storage=None):
         if not storage:
-            self._storage = LocalSymbolStorage(datetime.timedelta(hours=1))
+            self._storage = LocalSymbolStorage(PRICE_LIFETIME)
         else:
             self._storage = storage
-        self._alert_service = alert_service
+        # Решаем один раз при создании, а не на каждое сообщение
+        if isinstance(self._storage, LocalSymbolStorage):
+            self._store_sync = self._storage.store_sync
+        else:
+            self._store_sync = None
+        self._get_price = self._storage.get_price
+        self._alert = alert_service.alert
         self.symbol = symbol
         self.threshold = threshold
         self.calc = calc
+        # Стандартную метрику считаем прямо в reg_price, без вызова функции
+        self._drop_relative = calc is DROP_RELATIVE
+        self._msg_prefix = f'цена на {symbol} изменилась на '
 
     async def reg_price(self, price: float):
-        stored = self._storage.get_price()
-        diff = self.calc(stored, price)
-        # Тут очень хочется логировать происходящее
-        # Но в текущем виде оно сольется с принтами из alertService, поэтому ничего не выводим
-        # print(f'reg {self.symbol} for {price} at {datetime.datetime.now()}; diff {diff}')
-        if diff > self.threshold:
-            await self._alert_service.alert(
-                f'цена на {self.symbol} изменилась на {diff * 100:.2f}%'
-            )
-        await self._storage.store(PriceAtTime(price, datetime.datetime.now()))
+        stored = self._get_price()
+        # Для самой первой цены сравнивать не с чем, просто сохраняем её
+        if stored is not None:
+            if self._drop_relative:
+                diff = (stored - price) / price
+            else:
+                diff = self.calc(stored, price)
+            # Тут очень хочется логировать происходящее
+            # Но в текущем виде оно сольется с принтами из alertService, поэтому ничего не выводим
+            # print(f'reg {self.symbol} for {price} at {datetime.datetime.now()}; diff {diff}')
+            if diff > self.threshold:
+                self._alert(f'{self._msg_prefix}{diff * 100:.2f}%')
+        ts = asyncio.get_running_loop().time()
+        if self._store_sync:
+            self._store_sync(price, ts)
+        else:
+            await self._storage.store(price, ts)
 
 
 def init_monitors(config):
@@ -151,38 +220,88 @@ def init_monitors(config):
     monitors = {}
     for symbol_config in config:
         symbol, threshold = symbol_config.get('symbol'), symbol_config.get('alert_threshold')
-        stream_name = f'{symbol_config.get("symbol")}@trade'
+        stream_name = f'{symbol}@trade'
+        storage = LocalSymbolStorage(PRICE_LIFETIME,
+                                     datetime.timedelta(seconds=symbol_config.get('dedup_interval', 0)))
         monitors[stream_name] = SymbolMonitor(symbol, threshold, DROP_RELATIVE,
-                                              alert_service=alert_service)
+                                              alert_service=alert_service, storage=storage)
+
+    # Связываем всё нужное заранее, чтобы в хендлере не искать атрибуты на каждое сообщение
+    # По имени потока сразу получаем связанный метод reg_price, а не сам монитор
+    # Если монитор для потока не создан, __getitem__ сам выбросит KeyError
+    decode = _decoder.decode
+    get_reg_price = {stream: monitor.reg_price for stream, monitor in monitors.items()}.__getitem__
 
     async def handler(msg):
-        parsed = json.loads(msg)
-        stream = parsed.get("stream")
-        monitor = monitors[stream]
-        if not monitor:
-            raise Exception(f"Monitor for stream {stream} not created")
-        await monitor.reg_price(float(parsed.get('data').get('p')))
+        frame = decode(msg)
+        await get_reg_price(frame.stream)(frame.data.p)
 
-    return monitors.keys(), handler
+    return tuple(monitors), handler
 
 
-async def create_websocket(symbols, handler):
+async def _handle_frames(ws, handler):
     """
-    Открываем веб сокет и бесконечно слушаем его
+    Отдельная очередь не нужна: recv не уходит в event loop,
+    если у websockets уже есть принятые сообщения, поэтому они обрабатываются подряд
+
+    """
+    async for msg in ws:
+        await handler(msg)
+
+
+async def _supervise(symbols, handler):
+    """
+    Держим одно соединение для группы символов и переподключаемся, если оно оборвалось
+    или сервер его закрыл. Перед каждой новой попыткой ждём, каждый раз в два раза дольше,
+    пока соединение не начнёт присылать сообщения
+    Отдельная задача для keepalive не нужна: websockets сам отправляет ping
 
     """
     url = f'{BASE_URL}?streams={"/".join(symbols)}'
-    print('connecting to:', url)
-    async with websockets.connect(url) as ws:
-        while True:
-            msg = await ws.recv()
-            await handler(msg)
+    delay = RECONNECT_DELAY_MIN
+    while True:
+        print('connecting to:', url)
+        try:
+            # Сообщения Binance - маленькие JSON, сжатие почти ничего не даёт, а zlib тратит CPU на каждый кадр
+            # max_queue - сколько принятых сообщений websockets держит в буфере, прежде чем перестать
+            # читать из сокета. Запас побольше сглаживает всплески, пока обработчик занят,
+            # ценой памяти: если обработчик зависнет, в буфере накопится до WS_MAX_QUEUE сообщений,
+            # после чего чтение встанет и Binance упрётся в TCP backpressure
+            async with websockets.connect(url, compression=None, max_queue=WS_MAX_QUEUE) as ws:
+                # Сбрасываем задержку, только когда пришло первое сообщение: иначе сервер,
+                # который принимает соединение и сразу его закрывает, вызовет переподключение без пауз
+                msg = await ws.recv()
+                delay = RECONNECT_DELAY_MIN
+                await handler(msg)
+                await _handle_frames(ws, handler)
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            print(f'connection lost: {e!r}')
+        print(f'reconnecting in {delay}s')
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+async def create_websocket(symbols, handler):
+    """
+    Открываем веб сокеты и бесконечно слушаем их
+    Символы делим на группы по MAX_STREAMS_PER_CONNECTION, на каждую своё соединение:
+    так медленный поток одной группы не задерживает остальные
+
+    """
+    async with asyncio.TaskGroup() as tg:
+        for i in range(0, len(symbols), MAX_STREAMS_PER_CONNECTION):
+            tg.create_task(_supervise(symbols[i:i + MAX_STREAMS_PER_CONNECTION], handler))
 
 
 if __name__ == '__main__':
     url, handler = init_monitors(symbols_config)
-    loop = asyncio.new_event_loop()
-    loop.run_until_complete(create_websocket(url, handler))
+    try:
+        # Event loop на libuv заметно быстрее стандартного, но доступен не везде (например, не на Windows)
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    run(create_websocket(url, handler))
 """
 Отвечая на 2 часть задания, я постарался сделать приложение модульным и масштабируемым
 Добавить отслеживание любого количества пар очень легко - достаточно изменить symbols_config 
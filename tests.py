@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, Mock, patch
 
 from binance import *
 
@@ -7,7 +7,32 @@ from binance import *
 class BinanceTest(unittest.TestCase):
     class AlertServiceMock:
         def __init__(self):
-            self.alert = AsyncMock()
+            self.alert = Mock()
+
+    class WebSocketMock:
+        """
+        Отдаёт сообщения по порядку, а затем ведёт себя как штатно закрытое соединение
+        """
+        def __init__(self, messages):
+            self.messages = iter(messages)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def recv(self):
+            for msg in self.messages:
+                return msg
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+
+        async def __aiter__(self):
+            for msg in self.messages:
+                yield msg
+
+    class Stop(Exception):
+        pass
 
     def test_alert_called(self):
         a = self.AlertServiceMock()
@@ -31,15 +56,110 @@ class BinanceTest(unittest.TestCase):
         loop.run_until_complete(monitor.reg_price(99.8))
         a.alert.assert_not_called()
 
+    def test_first_price(self):
+        a = self.AlertServiceMock()
+        calc = Mock(return_value=1)
+        monitor = SymbolMonitor("test", 0.01, calc, alert_service=a)
+        assert monitor._storage.get_price() is None
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(monitor.reg_price(10))
+        calc.assert_not_called()
+        a.alert.assert_not_called()
+        assert monitor._storage.get_price() == 10
+
     def test_lifetime(self):
         a = self.AlertServiceMock()
         loop = asyncio.new_event_loop()
         monitor = SymbolMonitor("test", 0.01, lambda old, new: (old - new) / new,
                                 alert_service=a
                                 )
-        h = monitor._storage._price_history
-        h[100] = PriceAtTime(100, datetime.datetime.now())
-        h[500] = PriceAtTime(500, datetime.datetime.now() - datetime.timedelta(hours=1, minutes=1))
-        monitor._storage._max_key = 500
+        storage = monitor._storage
+        storage._prices.extend([500, 100])
+        storage._timestamps.extend([loop.time() - datetime.timedelta(hours=1, minutes=1).total_seconds(), loop.time()])
         loop.run_until_complete(monitor.reg_price(101))
-        assert len(h) == 3
+        assert len(storage._prices) == len(storage._timestamps) == 1
+        assert storage.get_price() == 101
+
+    def test_handler(self):
+        loop = asyncio.new_event_loop()
+        msg = '{"stream": "test@trade", "data": {"e": "trade", "s": "TEST", "p": "0.5432", "q": "10"}}'
+        with patch.object(SymbolMonitor, 'reg_price', new=AsyncMock()) as reg_price:
+            streams, handler = init_monitors([{"symbol": "test", "alert_threshold": 0.01}])
+            loop.run_until_complete(handler(msg))
+        reg_price.assert_awaited_once_with(0.5432)
+
+    def test_websocket_messages(self):
+        messages = [f'msg{i}' for i in range(5)]
+        handler = AsyncMock()
+        loop = asyncio.new_event_loop()
+        connect = patch('websockets.connect', side_effect=[self.WebSocketMock(messages), self.Stop()])
+        with connect, patch('asyncio.sleep', new=AsyncMock()):
+            with self.assertRaises(ExceptionGroup) as cm:
+                loop.run_until_complete(create_websocket(['test@trade'], handler))
+        assert cm.exception.subgroup(self.Stop) is not None
+        # Все сообщения переданы обработчику по порядку, а после закрытия соединения было переподключение
+        self.assertEqual([c.args[0] for c in handler.await_args_list], messages)
+
+    def test_websocket_reconnect(self):
+        messages = [f'msg{i}' for i in range(3)]
+        handler = AsyncMock()
+        loop = asyncio.new_event_loop()
+        connect = patch('websockets.connect',
+                        side_effect=[OSError(), OSError(), self.WebSocketMock(messages), self.Stop()])
+        with connect, patch('asyncio.sleep', new=AsyncMock()) as sleep:
+            with self.assertRaises(ExceptionGroup):
+                loop.run_until_complete(create_websocket(['test@trade'], handler))
+        # После соединения, которое прислало сообщения, задержка сбрасывается
+        self.assertEqual([c.args[0] for c in sleep.await_args_list],
+                         [RECONNECT_DELAY_MIN, RECONNECT_DELAY_MIN * 2, RECONNECT_DELAY_MIN])
+        self.assertEqual([c.args[0] for c in handler.await_args_list], messages)
+
+    def test_websocket_clean_close(self):
+        # Сервер принимает соединение и сразу штатно закрывает его: переподключаемся с растущей задержкой
+        handler = AsyncMock()
+        loop = asyncio.new_event_loop()
+        connect = patch('websockets.connect',
+                        side_effect=[self.WebSocketMock([]) for _ in range(3)] + [self.Stop()])
+        with connect, patch('asyncio.sleep', new=AsyncMock()) as sleep:
+            with self.assertRaises(ExceptionGroup):
+                loop.run_until_complete(create_websocket(['test@trade'], handler))
+        self.assertEqual([c.args[0] for c in sleep.await_args_list],
+                         [RECONNECT_DELAY_MIN, RECONNECT_DELAY_MIN * 2, RECONNECT_DELAY_MIN * 4])
+        handler.assert_not_called()
+
+    def test_dedup_interval(self):
+        storage = LocalSymbolStorage(datetime.timedelta(hours=1), datetime.timedelta(seconds=1))
+        storage.store_sync(100, 0)
+        storage.store_sync(99, 0.5)
+        storage.store_sync(98, 2)
+        storage.store_sync(101, 2.5)
+        self.assertEqual(list(storage._prices), [101])
+        storage.store_sync(100, 3.6)
+        storage.store_sync(99, 3.8)
+        self.assertEqual(list(storage._prices), [101, 100])
+        self.assertEqual(list(storage._timestamps), [2.5, 3.6])
+        # Пропущенная цена не вернётся, когда более высокая уйдёт из окна: максимум занижен
+        storage = LocalSymbolStorage(datetime.timedelta(seconds=10), datetime.timedelta(seconds=5))
+        storage.store_sync(100, 0)
+        storage.store_sync(99, 4)
+        storage.store_sync(50, 10.5)
+        self.assertEqual(storage.get_price(), 50)
+        exact = LocalSymbolStorage(datetime.timedelta(seconds=10))
+        exact.store_sync(100, 0)
+        exact.store_sync(99, 4)
+        exact.store_sync(50, 10.5)
+        self.assertEqual(exact.get_price(), 99)
+        with self.assertRaises(ValueError):
+            LocalSymbolStorage(datetime.timedelta(seconds=1), datetime.timedelta(seconds=5))
+        with self.assertRaises(ValueError):
+            LocalSymbolStorage(datetime.timedelta(seconds=1), datetime.timedelta(seconds=1))
+
+    def test_drop_relative_inlined(self):
+        a = self.AlertServiceMock()
+        monitor = SymbolMonitor("test", 0.01, DROP_RELATIVE, alert_service=a)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(monitor.reg_price(100))
+        loop.run_until_complete(monitor.reg_price(99.8))
+        a.alert.assert_not_called()
+        loop.run_until_complete(monitor.reg_price(98))
+        a.alert.assert_called_once_with('цена на test изменилась на 2.04%')